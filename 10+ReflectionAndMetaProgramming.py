@@ -94,6 +94,70 @@ save_file('report', 'pdf')
 save_file('report', 'xyz')          # no match, default is used
 
 
+#%% Each call above creates a new plugin, builds a method name, and looks it
+#   up. When saving thousands of files, better build once a dispatch table,
+# mapping each extension to the (bound) method saving in that format. These
+# methods are found by reflection: all those whose name starts with save_as_
+# in the plugin(s) registered, so that other plugins can add formats too.
+class PluginRegistry:
+    '''Dispatch table from file extensions to the plugins' save methods'''
+    prefix = 'save_as_'
+
+    def __init__(self, *plugins, default='txt'):
+        self.table = {}
+        self.default = default
+        self.fallback = self.unknown
+        for plugin in plugins: self.register(plugin)
+
+    def register(self, plugin):
+        for attr in dir(plugin):
+            if attr.startswith(self.prefix):
+                self.table[attr[len(self.prefix):]] = getattr(plugin, attr)
+        self.fallback = self.table.get(self.default, self.unknown)
+
+    def unknown(self, name):
+        raise ValueError(f'no plugin to save {name}, not even in the'
+                         f' default format {self.default!r}')
+
+    def save_file(self, name, ext='txt'):
+        (self.table.get(ext) or self.fallback)(name)
+
+    def save_files(self, names, ext='txt'):
+        save = self.table.get(ext) or self.fallback     # only once
+        for name in names: save(name)
+
+class MarkdownPlugin(object):        # e.g. a third-party plugin
+    def save_as_md(self, name):
+        print('Saved Markdown file', name + '.md')
+
+registry = PluginRegistry(SavePlugin(), MarkdownPlugin())
+registry.table
+registry.save_file('report', 'md')
+registry.save_file('report', 'xyz') # no match, default is used
+registry.save_files(['jan', 'feb', 'mar'], 'pdf')
+
+def dispatch_time(files=1000):      # (bench: see compiling section)
+    names = [f'report{n}' for n in range(files)]
+    def one_by_one(names):
+        for name in names: save_file(name, 'pdf')
+    def registered(names):
+        for name in names: registry.save_file(name, 'pdf')
+    def direct(names):              # no dispatch at all, for reference
+        save = SavePlugin().save_as_pdf
+        for name in names: save(name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [bench(fun, names, name=name) for fun, name in (
+            (direct, 'direct calls'), (one_by_one, 'save_file'),
+            (registered, 'registry.save_file'),
+            (registry.save_files, 'registry.save_files'))]
+    for r in results:
+        overhead = (r['median'] - results[0]['median']) / files
+        print(f'{r["name"]:>20}: {r["median"] / files * 1e6:6.3f} us per'
+              f' file, dispatch {overhead * 1e6:6.3f} us')
+
+#dispatch_time()
+
+
 
 ################################
 ##
@@ -125,6 +189,101 @@ ncc.listattr
 ncc.print()
 
 
+#%% Instances of the classes above each carry a __dict__, which is costly in
+#   memory when creating millions of them. A class factory can instead make
+# record classes with __slots__ (a fixed set of attributes, no __dict__) and
+# generate the source of their methods, compiled once per class, as is done
+# by dataclasses and namedtuple. Frozen records cannot be modified, and so
+# can be hashed (e.g. used in a set or as dictionary keys).
+import copy
+import keyword
+
+def record(name, fields, frozen=False):
+    '''Create a record class with __slots__ and generated methods'''
+    if isinstance(fields, str): fields = fields.replace(',', ' ').split()
+    fields = tuple(fields)
+    for n in (name,) + fields:          # (all pasted into the source!)
+        if not isinstance(n, str) or not n.isidentifier() \
+                or keyword.iskeyword(n):
+            raise ValueError(f'invalid name: {n!r}')
+    for f in fields:
+        if f.startswith('_') or f == 'self' or fields.count(f) > 1:
+            raise ValueError(f'invalid or duplicate field: {f!r}')
+    cls = type(name, (object,), {'__slots__': fields})
+    args = ', '.join(fields)
+    this = ''.join(f'self.{f}, ' for f in fields)
+    that = ''.join(f'other.{f}, ' for f in fields)
+    source = [f'def __init__(self, {args}):']
+    if frozen:                      # bypass __setattr__ (raising error)
+        source += [f'    _set_{f}(self, {f})' for f in fields]
+    else:
+        source += [f'    self.{f} = {f}' for f in fields]
+    if not fields: source += ['    pass']
+    source += ['def __repr__(self):',
+               f'    return f"{name}(' +
+               ', '.join(f'{f}={{self.{f}!r}}' for f in fields) + ')"',
+               'def __eq__(self, other):',
+               '    if other.__class__ is not self.__class__:',
+               '        return NotImplemented',
+               f'    return ({this}) == ({that})']
+    if frozen:
+        source += ['def __hash__(self):',
+                   f'    return hash(({this}))',
+                   'def __setattr__(self, attr, value):',
+                   f'    raise AttributeError("{name} is frozen")',
+                   'def __delattr__(self, attr):',
+                   f'    raise AttributeError("{name} is frozen")',
+                   'def __getstate__(self):',   # for copy and pickle,
+                   f'    return ({this})',      # bypassing __setattr__
+                   'def __setstate__(self, state):']
+        source += [f'    _set_{f}(self, state[{i}])'
+                   for i, f in enumerate(fields)] or ['    pass']
+    scope = {f'_set_{f}': getattr(cls, f).__set__ for f in fields}
+    exec(compile('\n'.join(source), f'<record {name}>', 'exec'), scope)
+    for method in ('__init__', '__repr__', '__eq__', '__hash__',
+                   '__setattr__', '__delattr__', '__getstate__',
+                   '__setstate__'):
+        if method in scope: setattr(cls, method, scope[method])
+    if not frozen: cls.__hash__ = None  # mutable: equal but not hashable
+    cls._fields = fields
+    return cls
+
+Point = record('Point', 'x y')
+p = Point(1, 2)
+p
+p.x = 3                             # a mutable record
+p == Point(3, 2)
+#p.z = 0                            # AttributeError: no __dict__ here!
+
+Colour = record('Colour', ['r', 'g', 'b'], frozen=True)
+red = Colour(255, 0, 0)
+{red: 'red'}
+#red.g = 100                        # AttributeError: Colour is frozen
+#del red.g                          # AttributeError: Colour is frozen
+copy.deepcopy(red) == red
+#record('Point', 'x y x')           # ValueError: duplicate field
+
+def record_time(number=100000):     # (bench: see compiling section)
+    import tracemalloc
+    def init(self, x, y):
+        self.x = x
+        self.y = y
+    classes = [('type() class', type('Plain', (object,), {'__init__': init})),
+               ('record', record('Slotted', 'x y')),
+               ('frozen record', record('Frozen', 'x y', frozen=True))]
+    for name, cls in classes:
+        tracemalloc.start()
+        objects = [cls(n, n) for n in range(number)]
+        size = tracemalloc.get_traced_memory()[0] / number
+        tracemalloc.stop()
+        del objects
+        result = bench(lambda: [cls(n, n) for n in range(number)], name=name)
+        print(f'{name:>15}: {size:5.0f} bytes, '
+              f'{result["median"] / number * 1e9:5.0f} ns per instance')
+
+#record_time()
+
+
 # see also getattr() examples earlier
 
 
@@ -173,7 +332,18 @@ class StringFunction:
         self._expr = expression
 
     def __call__(self, x):
-        return eval(self._expr)     # evaluate function expression!
+        return eval(compile_expr(self._expr))   # evaluate function expression!
+
+# note: Evaluating a string requires first parsing and compiling it, each time
+# (see next sections). So the compiled code is kept in a cache, shared by all
+# StringFunctions (and by all users of compile_expr), holding the most recently
+# used expressions, up to some maximum number: lru_cache does exactly that.
+from functools import lru_cache
+
+@lru_cache(maxsize=1024)
+def compile_expr(expression):
+    '''Return the compiled code of an expression, computed once only'''
+    return compile(expression, '<string>', 'eval')
 
 f = StringFunction('1+sin(2*x)')
 f._expr
@@ -235,35 +405,106 @@ greet('everyone')
 
 class StringFunction_compiled:      # faster with a compiled expression!
     def __init__(self, expression):
-        self._compiled_expr = compile(expression, '<string>', 'eval')
+        self._compiled_expr = compile_expr(expression)      # (cached too)
 
     def __call__(self, x):
         return eval(self._compiled_expr)
 
-# Comparing performance: interpreted vs. compiled code
+# Comparing performance: interpreted vs. compiled code. Timing a piece of
+# code properly takes some care: time.time() may be too coarse (a fast enough
+# piece of code then seems to take no time at all!), the first runs are often
+# slower (caches...), and other programs running make timings vary. So bench()
+# uses the most precise clock, runs the code a few times first (warmup), then
+# calibrates the number of loops so that each measurement lasts long enough,
+# and repeats the measurement: the median time is robust to outliers, while
+# the inter-quartile range (IQR) and the 95% confidence interval of the median
+# show how much timings vary. Results can be saved as JSON, and compared to
+# those of a previous run (e.g. before optimizing some code). See also timeit.
 import time
-def fun_time(fun, arg, num=10000):
-    start = time.time()
-    for _ in range(num): fun(arg)
-    end = time.time()
-    return end-start
+import json
+import math
+import statistics
+from itertools import repeat as _loops
+
+def bench(fun, *args, name=None, repeat=7, min_time=0.05, warmup=1):
+    '''Time fun(*args), return statistics of the time per call (seconds)'''
+    if repeat < 2:                      # (no quartiles from one value)
+        raise ValueError(f'repeat must be >= 2, not {repeat}')
+    def timed(loops):
+        start = time.perf_counter_ns()
+        for _ in _loops(None, loops): fun(*args)
+        return (time.perf_counter_ns() - start) / 1e9
+
+    for _ in range(warmup): fun(*args)
+    loops = 1
+    while (elapsed := timed(loops)) < min_time:     # calibrate
+        loops *= 2 if elapsed <= 0 else \
+            max(2, min(10, math.ceil(1.2 * min_time / elapsed)))
+    times = sorted(timed(loops) / loops for _ in range(repeat))
+    q1, median, q3 = statistics.quantiles(times, n=4, method='inclusive')
+    half = 1.96 * math.sqrt(repeat) / 2             # rank of the CI bounds
+    low = times[max(0, math.floor(repeat/2 - half) - 1)]
+    high = times[min(repeat - 1, math.ceil(repeat/2 + half))]
+    return {'name': name or getattr(fun, '__name__', repr(fun)),
+            'median': median, 'iqr': q3 - q1, 'ci95': [low, high],
+            'min': times[0], 'loops': loops, 'repeat': repeat}
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale: return f'{seconds/scale:7.3f} {unit}'
+    return f'{seconds/1e-9:7.1f} ns'
+
+def report(results):
+    for r in results:
+        low, high = r['ci95']
+        print(f'{r["name"]:>28}: {_format_time(r["median"])}'
+              f' +- {_format_time(r["iqr"]/2)}'
+              f' (95% CI {_format_time(low)} .. {_format_time(high)},'
+              f' {r["loops"]} loops x {r["repeat"]})')
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def compare(results, path):
+    '''Compare results with the baseline saved in a JSON file, by name'''
+    with open(path) as f:
+        baseline = {r['name']: r for r in json.load(f)}
+    for r in results:
+        b = baseline.get(r['name'])
+        if b is None:
+            print(f'{r["name"]:>28}: no baseline')
+            continue
+        if r['ci95'][1] < b['ci95'][0]: verdict = 'faster'
+        elif r['ci95'][0] > b['ci95'][1]: verdict = 'slower'
+        else: verdict = 'no significant change'
+        print(f'{r["name"]:>28}: {b["median"] / r["median"]:6.2f}x'
+              f' speed of baseline, {verdict}')
 
 def show_time(expr, arg):
-    interpreted_time = fun_time(StringFunction(expr), arg)
-    compiled_time =    fun_time(StringFunction_compiled(expr), arg)
-
-    print(' interpreted time =', interpreted_time)
-    print('    compiled time =', compiled_time)
-    try:
-        print('performance ratio =', round(interpreted_time/compiled_time,2))
-    except ZeroDivisionError:
-        print('error: compiled code was too fast!')
+    def cold(x):                    # each call compiles again, as eval(str)
+        compile_expr.cache_clear()
+        return f(x)
+    f = StringFunction(expr)
+    results = [bench(cold, arg, name='interpreted (cold cache)'),
+               bench(f, arg, name='interpreted (warm cache)'),
+               bench(StringFunction_compiled(expr), arg, name='compiled')]
+    report(results)
+    print(compile_expr.cache_info())
+    print('performance ratio =',
+          round(results[0]['median'] / results[2]['median'], 2))
+    return results
 
 show_time('atan(tan(atan(tan(atan(tan(atan(tan(x))))))))', pi/4)
 # e.g. ->
-#  interpreted time = 0.20150399208068848
-#     compiled time = 0.015629053115844727
-# performance ratio = 12.89 !
+#     interpreted (cold cache):  35.912 us +-   0.305 us (95% CI ...)
+#     interpreted (warm cache):   1.195 us +-  12.160 ns (95% CI ...)
+#                     compiled:   1.057 us +-   7.015 ns (95% CI ...)
+# CacheInfo(hits=458752, misses=1, maxsize=1024, currsize=1)
+# performance ratio = 33.98 !
+
+#save_results(show_time('atan(tan(x))', pi/4), 'baseline.json')
+#compare(show_time('atan(tan(x))', pi/4), 'baseline.json')
 
 
 # So we can do numerical calculations in Python with the performance of C!
@@ -274,6 +515,172 @@ show_time('atan(tan(atan(tan(atan(tan(atan(tan(x))))))))', pi/4)
 # code beforehand, then 'exec' will execute the bytecode directly.
 
 
+#%% Evaluating a formula at a million points still means a million calls to
+#   eval. With numpy, the formula can instead be evaluated once, over a whole
+# array of points, by binding the math functions (sin, cos, atan...) to their
+# numpy equivalents, which process entire arrays in compiled code. Some
+# expressions cannot work on arrays, e.g. 'x if x > 0 else -x' or calls to
+# functions expecting a single number; these fall back to one eval per item.
+try:
+    import numpy as np
+    NUMPY_FUNCTIONS = {name: getattr(np, np_name) for name, np_name in {
+        'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'asin': 'arcsin',
+        'acos': 'arccos', 'atan': 'arctan', 'atan2': 'arctan2',
+        'sinh': 'sinh', 'cosh': 'cosh', 'tanh': 'tanh', 'exp': 'exp',
+        'log': 'log', 'log10': 'log10', 'log2': 'log2', 'sqrt': 'sqrt',
+        'fabs': 'fabs', 'floor': 'floor', 'ceil': 'ceil', 'hypot': 'hypot',
+        'pow': 'power', 'pi': 'pi', 'e': 'e'}.items()}
+except ModuleNotFoundError:
+    np = None                       # (so, always item by item)
+
+class StringFunction_vectorized(StringFunction):
+    def __call__(self, x):
+        if np is None or not isinstance(x, np.ndarray):
+            return StringFunction.__call__(self, x)         # scalar path
+        try:
+            y = eval(compile_expr(self._expr),
+                     {**globals(), **NUMPY_FUNCTIONS}, {'x': x})
+        except (TypeError, ValueError):     # not vectorizable
+            y = None
+        if y is not None and np.ndim(y) == 0:
+            return np.full(x.shape, y)      # constant expression
+        if y is None or np.shape(y) != x.shape:
+            y = np.array([StringFunction.__call__(self, v)
+                          for v in x.ravel().tolist()]).reshape(x.shape)
+        return y
+
+g = StringFunction_vectorized('1+sin(2*x)')
+g(pi/4)                             # still works on a single point
+#g(np.linspace(0, pi, 5))           # one eval for all 5 points
+
+def vector_time(expr, sizes=(10**3, 10**4, 10**5, 10**6, 10**7),
+                scalar_max=10**6):
+    f = StringFunction_compiled(expr)
+    g = StringFunction_vectorized(expr)
+    def scalar(xs):
+        for x in xs: f(x)
+    results = []
+    for size in sizes:
+        xs = np.linspace(0, pi/2, size)
+        results.append(bench(g, xs, name=f'vectorized, {size} points',
+                             repeat=3, warmup=0))
+        if size <= scalar_max:      # (too slow above)
+            results.append(bench(scalar, xs.tolist(), repeat=3, warmup=0,
+                                 name=f'scalar, {size} points'))
+    report(results)
+    return results
+
+#vector_time('atan(tan(atan(tan(atan(tan(atan(tan(x))))))))')
+
+
+#%% Even compiled, each call to eval has a cost (setting up a frame to run
+#   the code, looking up names such as 'sin' in the globals). Going one step
+# further, a formula can be turned into a real Python function: parse it into
+# an abstract syntax tree (AST, see module ast), check that it only uses safe
+# constructs (arithmetic, comparisons, math functions: no attribute access,
+# no __import__...) thus addressing the WARNING above, then pre-compute the
+# parts that do not depend on x (constant folding, e.g. sin(pi/4)), and
+# finally compile 'lambda x: ...' with the math functions bound in a closure.
+import ast
+
+SAFE_FUNCTIONS = {name: getattr(math, name) for name in (
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2', 'sinh', 'cosh',
+    'tanh', 'exp', 'log', 'log10', 'log2', 'sqrt', 'fabs', 'floor', 'ceil',
+    'hypot', 'pow', 'pi', 'e')}
+SAFE_FUNCTIONS.update(abs=abs, min=min, max=max, round=round)
+
+SAFE_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+              ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant,
+              ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+
+class ConstantFolder(ast.NodeTransformer):
+    '''Replace the sub-expressions made of constants only by their value'''
+    max_bits = 128                      # as CPython's own optimizer
+
+    def __init__(self, var='x'):
+        self.var = var
+        self.values = {}                # bound as closure arguments
+
+    def value(self, node):
+        if isinstance(node, ast.Constant): return node.value
+        if isinstance(node, ast.Name): return self.values.get(node.id)
+
+    def too_large(self, node):          # e.g. 9**9**9 would never end
+        if not isinstance(node, ast.BinOp): return False
+        left, right = self.value(node.left), self.value(node.right)
+        if type(left) is not int or type(right) is not int: return False
+        if isinstance(node.op, ast.Pow):
+            return right > 0 and left.bit_length() * right > self.max_bits
+        if isinstance(node.op, ast.Mult):
+            return left.bit_length() + right.bit_length() > self.max_bits
+        if isinstance(node.op, ast.LShift):
+            return right > self.max_bits
+        return False
+
+    def generic_visit(self, node):
+        node = super().generic_visit(node)
+        if not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp,
+                                 ast.Compare, ast.IfExp, ast.Call)):
+            return node
+        names = [n.id for n in ast.walk(node) if isinstance(n, ast.Name)]
+        if isinstance(node, ast.Call): names.remove(node.func.id)
+        if any(name not in self.values and (name not in SAFE_FUNCTIONS
+               or callable(SAFE_FUNCTIONS[name])) for name in names) \
+                or self.too_large(node):    # depends on x, calls nested...
+            return node
+        try:
+            value = eval(compile(ast.Expression(node), '<fold>', 'eval'),
+                         {'__builtins__': {}, **SAFE_FUNCTIONS, **self.values})
+        except Exception:               # e.g. 1/0, left for run time
+            return node
+        name = f'{self.var}_{len(self.values)}'  # (not its repr: -2 ** x!)
+        self.values[name] = value
+        return ast.copy_location(ast.Name(name, ast.Load()), node)
+
+@lru_cache(maxsize=1024)
+def compile_formula(expression, var='x'):
+    '''Return a function of var computing the formula, if it is safe'''
+    tree = ast.parse(expression, mode='eval')
+    for node in ast.walk(tree):
+        if not isinstance(node, SAFE_NODES):
+            raise ValueError(f'{type(node).__name__} not allowed: {expression}')
+        if isinstance(node, ast.Name) and node.id not in SAFE_FUNCTIONS \
+                and node.id != var:
+            raise ValueError(f'unknown name {node.id}: {expression}')
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and not node.keywords
+                and callable(SAFE_FUNCTIONS.get(node.func.id))):
+            raise ValueError(f'invalid call: {expression}')
+        if isinstance(node, ast.Constant) and \
+                type(node.value) not in (int, float, complex, bool):
+            raise ValueError(f'invalid constant {node.value!r}: {expression}')
+    folder = ConstantFolder(var)
+    body = folder.visit(tree).body
+    names = sorted({n.id for n in ast.walk(body)
+                    if isinstance(n, ast.Name) and n.id != var})
+    values = {**SAFE_FUNCTIONS, **folder.values}
+    source = (f'def make({", ".join(names)}):\n'
+              f'    return lambda {var}: {ast.unparse(body)}')
+    namespace = {'__builtins__': {}}    # nothing else is reachable
+    exec(compile(source, f'<formula {expression}>', 'exec'), namespace)
+    return namespace['make'](*[values[name] for name in names])
+
+h = compile_formula('1+sin(2*x)')
+h(pi/4)                             # a plain function call: no eval!
+h = compile_formula('x * sin(pi/4)')
+[cell.cell_contents for cell in h.__closure__]  # sin(pi/4) computed once
+compile_formula('(-2)**x')(2)       # 4, and not -(2**x)
+compile_formula('x + 9**9**9')      # too large to fold, left for run time
+#compile_formula("__import__('os').system('rm -rf $HOME')") # ValueError
+
+expr = 'atan(tan(atan(tan(atan(tan(atan(tan(x))))))))'
+report([bench(StringFunction_compiled(expr), pi/4, name='compiled'),
+        bench(compile_formula(expr), pi/4, name='function')])
+# e.g. ->
+#                     compiled:   1.057 us +-   0.007 us (95% CI ...)
+#                     function: 629.480 ns +-   4.925 ns (95% CI ...)
+
+
 #%% Compiling then executing code
 ccode = compile('res = 11 + 22', '<string>', 'exec')
 
@@ -292,7 +699,10 @@ print(res)
 # (The more complex the code, the larger the performance gap.)
 
 
-def timefact(val=2000):
+import io
+import contextlib
+
+def timefact(val=500):     # fact recurses val deep: keep below the limit
     def fact(n):
         return 1 if n == 1 else n * fact(n-1)
     #def fact(n, f=1):
@@ -300,34 +710,105 @@ def timefact(val=2000):
     code = f'print(fact({val}))'
     print('code:',code)
     bytecode = compile(code, '<string>', 'exec')
-
-    se = time.time()
-    eval(code)
-    ee = time.time()
-
-    sx = time.time()
-    exec(code)
-    ex = time.time()
-
-    sc = time.time()
-    exec(bytecode)
-    ec = time.time()
-
-    print('     eval code - time =', ee-se)
-    print('     exec code - time =', ex-sx)
-    print(' exec bytecode - time =', ec-sc)
-    #print('performance ratio =', round((ee-se)/(ex-sx),2))
-    #print('performance ratio =', round((ex-sx)/(ec-sc),2))
+    scope = {'fact': fact}
+
+    with contextlib.redirect_stdout(io.StringIO()):     # (prints a lot!)
+        results = [bench(eval, code, scope, name='eval code'),
+                   bench(exec, code, scope, name='exec code'),
+                   bench(exec, bytecode, scope, name='exec bytecode')]
+    report(results)
+    return results
 # e.g. ->
-#     eval code - time = 0.0781095027923584
-#     exec code - time = 0.0468752384185791
-# exec bytecode - time = 0.03125262260437012
+#                    eval code: 246.916 us +-   9.017 us (95% CI ...)
+#                    exec code: 279.441 us +-   8.383 us (95% CI ...)
+#                exec bytecode: 236.286 us +-  11.396 us (95% CI ...)
 
 # note: All Python code imported from a module is automatically compiled the
 # first time (or if the module file has changed) to a .pyc file. Code in the
 # main is not compiled, unless explicitly as illustrated above.
 
 
+#%% The same can be done for any code string or script that is executed
+#   again and again, run after run: compile it once, save the code object in
+# a file (serialized with marshal, as .pyc files are), and next time load it
+# instead of compiling again. Files are named after a hash of the source code
+# and of Python's "magic number", as the bytecode differs between versions.
+import os
+import stat
+import marshal
+import hashlib
+import importlib.util
+
+# Loading code from a file then executing it is only safe if no one else can
+# write there: so the cache is kept in the user's own (private) directory.
+CODE_CACHE = os.path.join(os.environ.get('LOCALAPPDATA') or
+                          os.environ.get('XDG_CACHE_HOME') or
+                          os.path.expanduser(os.path.join('~', '.cache')),
+                          'python-code-cache')
+
+def private_dir(path):
+    '''Create path if needed, return whether only the user can access it'''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)               # (and not a symbolic link)
+    if not stat.S_ISDIR(info.st_mode):
+        return False
+    if hasattr(os, 'getuid'):           # POSIX: owner and permissions
+        return info.st_uid == os.getuid() and not info.st_mode & 0o077
+    return True
+
+def cached_compile(source, filename='<string>', mode='exec',
+                   cache_dir=CODE_CACHE):
+    '''Same as compile(), reusing the code compiled by any previous run'''
+    try:
+        if not private_dir(cache_dir):  # e.g. created by someone else
+            return compile(source, filename, mode)
+    except OSError:                     # e.g. read-only: just no caching
+        return compile(source, filename, mode)
+    magic = importlib.util.MAGIC_NUMBER
+    key = hashlib.sha256(magic + f'{filename}\0{mode}\0{source}'.encode())
+    path = os.path.join(cache_dir, key.hexdigest() + '.bin')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.startswith(magic):
+            return marshal.loads(data[len(magic):])
+    except (OSError, ValueError, EOFError):     # not cached yet, or corrupt
+        pass
+    code = compile(source, filename, mode)
+    try:
+        temp = f'{path}.{os.getpid()}'
+        with open(temp, 'wb') as f:
+            f.write(magic + marshal.dumps(code))
+        os.replace(temp, path)          # so never a half-written file
+    except OSError:                     # e.g. read-only: just no caching
+        pass
+    return code
+
+def exec_file(path, scope=None):
+    '''Execute a Python script, compiled once only (across runs)'''
+    with open(path) as f:
+        source = f.read()
+    if scope is None: scope = {'__name__': '__main__', '__file__': path}
+    exec(cached_compile(source, path), scope)
+    return scope
+
+#exec(cached_compile('res = 11 + 22'))   # (saved in CODE_CACHE)
+#eval(cached_compile('a + b', mode='eval'))
+
+def cache_time(functions=2000):     # a large, generated script
+    source = '\n'.join(f'''
+def fun{n}(x, y={n}):
+    if x > y: return [i * y for i in range(x) if i % {n+2}]
+    return {{'x': x, 'y': y, 'sum': sum(range(y))}}
+''' for n in range(functions))
+    cached_compile(source)          # (in case it is not cached yet)
+    report([bench(compile, source, '<string>', 'exec', name='compile',
+                  repeat=5, warmup=0),
+            bench(cached_compile, source, name='cached compile', repeat=5)])
+
+#cache_time()
+
+
 #%% More code anatomy
 
 code_str = 'print("Hello, world")'  # a simple piece of code
@@ -349,6 +830,78 @@ def f(): print('Hello, world')
 dis.dis(f.__code__)                 # now a function, so there is more code
 
 
+#%% Profiling bytecode: a trace function (see sys.settrace) can be called by
+#   the interpreter for each bytecode instruction executed (opcode event) in
+# each frame. Counting them, and timing the intervals between them, shows
+# where the time goes, instruction by instruction, which dis alone cannot.
+# (note: the tracing itself slows things down, so times are only relative)
+import sys
+from collections import Counter
+
+def profile_bytecode(fun, *args):
+    '''Count and time the bytecode instructions executed by fun(*args)'''
+    counts, times = Counter(), Counter()
+    last = [None, 0.0]
+    def trace(frame, event, arg):
+        now = time.perf_counter()
+        if last[0]: times[last[0]] += now - last[1]
+        if event == 'call':
+            frame.f_trace_opcodes = True
+            frame.f_trace_lines = False
+            last[0] = None
+        elif event == 'opcode':
+            last[0] = frame.f_code, frame.f_lasti
+            counts[last[0]] += 1
+        else: last[0] = None        # return, exception
+        last[1] = time.perf_counter()
+        return trace
+    start = time.perf_counter()
+    sys.settrace(trace)
+    try:
+        fun(*args)
+    finally:
+        sys.settrace(None)
+    return counts, times, time.perf_counter() - start
+
+def hot_instructions(counts, times, elapsed, name='', top=8):
+    '''Report the instructions that took the most time'''
+    instructions = {}
+    for code in {code for code, _ in counts}:
+        for i in dis.get_instructions(code):
+            instructions[code, i.offset] = i
+    traced = sum(times.values())
+    print(f'{name}: {sum(counts.values())} instructions, {elapsed * 1e3:.3f}'
+          f' ms ({traced / elapsed:.0%} traced)')
+    lines = Counter()
+    for key, t in times.items():
+        lines[key[0].co_name, instructions[key].positions.lineno] += t
+    for (function, line), t in lines.most_common(3):
+        print(f'{t / traced:6.1%} {"line":>7} {function:>16}:{line}')
+    for key, t in times.most_common(top):
+        i, code = instructions[key], key[0]
+        print(f'{t / traced:6.1%} {counts[key]:7} {code.co_name:>16}:'
+              f'{i.positions.lineno:<4} {i.offset:4} {i.opname:<20}'
+              f' {i.argrepr[:20]}')
+
+def fact_recursive(n):
+    return 1 if n == 1 else n * fact_recursive(n-1)
+
+def fact_tail(n, f=1):
+    return f if n == 1 else fact_tail(n-1, n*f)
+
+def profile_demo(n=500):            # (factorial: see testing section)
+    code = f'fact_recursive({n})'
+    variants = {'recursive': (fact_recursive, n), 'tail': (fact_tail, n),
+                'loop': (factorial, n),
+                'eval code': (eval, code),
+                'exec bytecode': (exec, compile(code, '<string>', 'exec'))}
+    for name, (fun, *args) in variants.items():
+        hot_instructions(*profile_bytecode(fun, *args), name=name)
+        print()
+
+#profile_demo()
+
+
 
 ################################
 ##
@@ -385,6 +938,78 @@ def factorial(n):
         factor += 1
     return result
 
+# Multiplying 2, 3, ... n in sequence makes one big integer grow slowly, and
+# each step multiplies it by a small one. Splitting the range in two halves,
+# recursively, instead multiplies numbers of similar sizes, which is where
+# the (Karatsuba) big integer multiplication is efficient.
+def product(lo, hi):
+    '''Return the product of the integers lo..hi-1, by binary splitting
+
+    >>> product(1, 11) == factorial(10)
+    True
+    '''
+    if hi - lo <= 8:
+        result = 1
+        for factor in range(lo, hi): result *= factor
+        return result
+    mid = (lo + hi) // 2
+    return product(lo, mid) * product(mid, hi)
+
+def fast_factorial(n, checkpoints=None):
+    '''Return the factorial of n, resuming from the nearest checkpoint
+
+    >>> cache = {}
+    >>> [fast_factorial(n, cache) for n in (30, 5, 20)] == \\
+    ...     [factorial(n) for n in (30, 5, 20)]
+    True
+    >>> sorted(cache)
+    [5, 20, 30]
+    '''
+    if not n >= 0:
+        raise ValueError('n must be >= 0')
+    if checkpoints is None:
+        return product(2, n + 1)
+    start = max((k for k in checkpoints if k <= n), default=1)
+    result = checkpoints.get(start, 1) * product(start + 1, n + 1)
+    checkpoints[n] = result
+    return result
+
+def factorials(ns):
+    '''Return the factorials of all the ns, computing each product once
+
+    >>> factorials([5, 0, 3, 5])
+    [120, 1, 6, 120]
+    '''
+    results, last, result = {}, 1, 1
+    for n in sorted(set(ns)):
+        if not n >= 0:
+            raise ValueError('n must be >= 0')
+        if n > last:
+            result *= product(last + 1, n + 1)
+            last = n
+        results[n] = result
+    return [results[n] for n in ns]
+
+def factorial_time(sizes=(10**3, 10**4, 10**5, 10**6), loop_max=10**5):
+    for n in sizes:
+        variants = [(math.factorial, 'math.factorial'),
+                    (fast_factorial, 'binary splitting')]
+        if n <= loop_max:
+            variants.append((factorial, 'loop'))
+        results = [bench(fun, n, name=f'{name} {n}', repeat=3, warmup=0)
+                   for fun, name in variants]
+        report(results)
+    ns = list(range(1000, 20001, 1000))
+    report([bench(factorials, ns, name='factorials(ns)'),
+            bench(lambda: [fast_factorial(n) for n in ns], name='one by one')])
+
+#factorial_time()
+# e.g. ->   math.factorial 100000: 201.500 ms ...
+#         binary splitting 100000: 273.665 ms ...
+#                     loop 100000:   4.813 s  ...
+#                   factorials(ns):  40.286 ms ...
+#                       one by one: 222.383 ms ...
+
 if __name__ == '__main__':          # top-level script
     import doctest
     doctest.testmod()
@@ -407,6 +1032,101 @@ def nF(n):
     else: return 0
 
 
+#%% Testing all lecture files: doctest.testmod() only checks the current
+#   module, and importing the other files would run all their demos. Instead
+# each file is parsed, and only its imports, definitions and CONSTANTS run, so
+# that the examples in their doc strings can be found and run, each file in
+# a separate process. Timing each example shows which are slow.
+import glob
+import types
+import doctest
+from concurrent.futures import ProcessPoolExecutor
+
+def load_definitions(path):
+    '''Load a file as a module, running only its imports and definitions'''
+    with open(path, encoding='utf-8') as file:
+        tree = ast.parse(file.read(), path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = types.ModuleType(name)
+    module.__file__ = path
+    errors = {}                     # report each error only once
+    for node in tree.body:
+        if isinstance(node, ast.Try):       # e.g. optional imports
+            keep = all(isinstance(n, (ast.Import, ast.ImportFrom))
+                       for n in node.body)
+        elif isinstance(node, ast.Assign):
+            keep = all(isinstance(t, ast.Name) and t.id.isupper()
+                       for t in node.targets)
+        else:
+            keep = isinstance(node, (ast.Import, ast.ImportFrom,
+                ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        if keep:
+            try:                    # (quietly, e.g. import this)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    exec(compile(ast.Module([node], []), path, 'exec'),
+                         module.__dict__)
+            except Exception as error:      # e.g. missing library
+                errors.setdefault(repr(error), f'{path}:{node.lineno}')
+    return module, [f'{where}: {error}' for error, where in errors.items()]
+
+class TimedRunner(doctest.DocTestRunner):
+    '''DocTestRunner recording the time and outcome of each example'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = []
+
+    def report_start(self, out, test, example):
+        self.start = time.perf_counter()
+
+    def record(self, test, example, outcome):
+        line = test.lineno + example.lineno + 1
+        self.timings.append((time.perf_counter() - self.start, outcome,
+                             f'{test.filename}:{line}', example.source.strip()))
+
+    def report_success(self, out, test, example, got):
+        self.record(test, example, 'ok')
+
+    def report_failure(self, out, test, example, got):
+        self.record(test, example, 'FAILED')
+        super().report_failure(out, test, example, got)
+
+    def report_unexpected_exception(self, out, test, example, exc_info):
+        self.record(test, example, 'ERROR')
+        super().report_unexpected_exception(out, test, example, exc_info)
+
+def doctest_file(path):
+    output = io.StringIO()
+    try:
+        module, errors = load_definitions(path)
+    except SyntaxError as error:
+        return path, [], f'{path}: not tested, {error!r}\n'
+    runner = TimedRunner(optionflags=doctest.ELLIPSIS)
+    for test in doctest.DocTestFinder().find(module):
+        if test.lineno is None: test.lineno = 0
+        runner.run(test, out=output.write)
+    return path, runner.timings, ''.join(e + '\n' for e in errors) + \
+                                 output.getvalue()
+
+def doctest_all(pattern='[0-9]*.py', workers=None, slowest=5):
+    '''Run the doc string examples of all (lecture) files, in parallel'''
+    start = time.perf_counter()
+    timings = []
+    with ProcessPoolExecutor(workers) as pool:
+        for path, times, output in pool.map(doctest_file,
+                                            sorted(glob.glob(pattern))):
+            print(output, end='')
+            timings += times
+    failed = sum(outcome != 'ok' for _, outcome, *_ in timings)
+    print(f'{len(timings)} examples, {failed} failed, '
+          f'{sum(t for t, *_ in timings):.3f}s in examples, '
+          f'{time.perf_counter() - start:.3f}s in total')
+    for elapsed, outcome, where, source in sorted(timings)[:-slowest-1:-1]:
+        print(f'{elapsed * 1e3:9.3f} ms {outcome:>6} {where}: {source[:40]}')
+    return timings
+
+#doctest_all()                      # in the directory of the lecture files
+
+
 
 ##
 ##  END
@@ -356,18 +356,126 @@ plt.show()
 
 import numpy as np
 
-def mandelbrot_set(xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon=2.0):
-    X = np.linspace(xmin, xmax, xn).astype(np.float32)
-    Y = np.linspace(ymin, ymax, yn).astype(np.float32)
-    C = X + Y[:, None] * 1j
-    N = np.zeros_like(C, dtype=int)
+def mandelbrot_grid(xmin, xmax, ymin, ymax, xn, yn, rows=slice(None)):
+    X = np.linspace(xmin, xmax, xn, dtype=np.float32)
+    Y = np.linspace(ymin, ymax, yn, dtype=np.float32)[rows]
+    return (X + Y[:, None] * np.complex64(1j)).astype(np.complex64)
+
+# Rather than testing all the grid points at each iteration, only those that
+# have not escaped yet are kept (with their index in the grid), and the set
+# is compacted once a quarter of them escaped (copying it at each iteration
+# would cost more than it saves). Squared moduli avoid computing square roots
+def escape_iterate(C, Z, N, index, start, stop, horizon=2.0):
+    '''Iterate the points C[index] from Z, return the index of those left'''
+    z, c = Z[index], C[index]           # points still iterating
+    alive, dead = np.ones(index.size, dtype=bool), 0
+    R, T = np.empty(index.size, np.float32), np.empty(index.size, np.float32)
+    horizon2 = np.float32(horizon) ** 2
+    with np.errstate(over='ignore', invalid='ignore'):  # escaped points
+        for n in range(start, stop):
+            if not z.size: break
+            z *= z                      # in place: z = z**2 + c
+            z += c
+            r, t = R[:z.size], T[:z.size]
+            np.multiply(z.real, z.real, out=r)
+            np.multiply(z.imag, z.imag, out=t)
+            r += t
+            out = r >= horizon2
+            out &= alive
+            escaped = np.flatnonzero(out)
+            if escaped.size:
+                N[index[escaped]] = n
+                Z[index[escaped]] = z[escaped]
+                alive[escaped] = False
+                dead += escaped.size
+                if 4 * dead >= z.size:  # compact
+                    index, z, c = index[alive], z[alive], c[alive]
+                    alive, dead = np.ones(z.size, dtype=bool), 0
+    Z[index[alive]] = z[alive]
+    return index[alive]
+
+def escape_time(C, maxiter, horizon=2.0):
+    shape = C.shape
+    C = C.astype(np.complex64).ravel()
+    N = np.zeros(C.size, dtype=int)
     Z = np.zeros_like(C)
-    for n in range(maxiter):
-        I = abs(Z) < horizon
-        N[I] = n
-        Z[I] = Z[I]**2 + C[I]
+    escape_iterate(C, Z, N, np.arange(C.size), 0, maxiter, horizon)
     N[N == maxiter-1] = 0
-    return Z, N
+    return Z.reshape(shape), N.reshape(shape)
+
+# Using several cores: the grid is split into bands of rows, computed by a
+# pool of processes writing their results directly into arrays in shared
+# memory (rather than pickling them back). Points inside the set cost many
+# more iterations, so there are many more bands than processes, so that
+# those done with cheap bands take more. (On Windows and macOS, processes
+# are spawned rather than forked, which re-runs this whole script...)
+import os
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+def shared_array(shape, dtype, name=None):
+    '''Return an array in (new, or existing if named) shared memory'''
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    memory = shared_memory.SharedMemory(name, create=name is None,
+                                        size=max(size, 1))
+    return np.ndarray(shape, dtype, buffer=memory.buf), memory
+
+def mandelbrot_band(args):
+    (xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon), rows, names = args
+    Z, zmemory = shared_array((yn, xn), np.complex64, names[0])
+    N, nmemory = shared_array((yn, xn), int, names[1])
+    C = mandelbrot_grid(xmin, xmax, ymin, ymax, xn, yn, slice(*rows))
+    Z[rows[0]:rows[1]], N[rows[0]:rows[1]] = escape_time(C, maxiter, horizon)
+    del Z, N                            # (release the buffers first)
+    zmemory.close()
+    nmemory.close()
+
+# Normalized recount as explained in:
+# https://linas.org/art-gallery/escape/smooth.html
+def smooth_count(Z, N, horizon=2.0):
+    log_horizon = np.log2(np.log(horizon))
+    # This line will generate warnings for null values but it is faster to
+    # process them afterwards using the nan_to_num
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nan_to_num(N + 1 - np.log2(np.log(abs(Z))) + log_horizon)
+
+def mandelbrot_set(xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon=2.0,
+                   tiles=None, workers=None):
+    if not tiles:
+        C = mandelbrot_grid(xmin, xmax, ymin, ymax, xn, yn)
+        return escape_time(C, maxiter, horizon)
+    view = xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon
+    Z, zmemory = shared_array((yn, xn), np.complex64)
+    N, nmemory = shared_array((yn, xn), int)
+    try:
+        bands = np.linspace(0, yn, min(tiles, yn) + 1).astype(int)
+        names = zmemory.name, nmemory.name
+        with ProcessPoolExecutor(workers) as pool:
+            list(pool.map(mandelbrot_band, [(view, rows, names)
+                          for rows in zip(bands[:-1], bands[1:])]))
+        return Z.copy(), N.copy()
+    finally:
+        del Z, N
+        for memory in (zmemory, nmemory):
+            memory.close()
+            memory.unlink()
+
+# For (very) large renders, computing the whole grid at once needs several
+# arrays of its size in memory. Instead, bands of rows are computed one at a
+# time and written to a memory-mapped .npy file, so that memory only depends
+# on the band size. The smooth colouring only needs the band's Z and N too.
+def mandelbrot_stream(path, xmin, xmax, ymin, ymax, xn, yn, maxiter,
+                      horizon=2.0, rows=64, smooth=False):
+    dtype = np.float32 if smooth else np.int32
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                    shape=(yn, xn))
+    for row in range(0, yn, rows):
+        band = slice(row, min(row + rows, yn))
+        C = mandelbrot_grid(xmin, xmax, ymin, ymax, xn, yn, band)
+        Z, N = escape_time(C, maxiter, horizon)
+        out[band] = smooth_count(Z, N, horizon) if smooth else N
+    out.flush()
+    return out                          # (np.load(path, mmap_mode='r'))
 
 import time
 import matplotlib
@@ -378,16 +486,8 @@ xmin, xmax, xn = -2.25, +0.75, 3000 // 2
 ymin, ymax, yn = -1.25, +1.25, 2500 // 2
 maxiter = 200
 horizon = 2.0 ** 40
-log_horizon = np.log2(np.log(horizon))
 Z, N = mandelbrot_set(xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon)
-
-# Normalized recount as explained in:
-# https://linas.org/art-gallery/escape/smooth.html
-
-# This line will generate warnings for null values but it is faster to
-# process them afterwards using the nan_to_num
-with np.errstate(invalid='ignore'):
-    M = np.nan_to_num(N + 1 - np.log2(np.log(abs(Z))) + log_horizon)
+M = smooth_count(Z, N, horizon)
 
 dpi = 72
 width = 10
@@ -413,6 +513,321 @@ ax.text(xmin+.025, ymin+.025, text, color='white', fontsize=12, alpha=0.5)
 plt.show()
 
 
+#%% Timing the escape-time engine above against the straightforward version,
+#   iterating over the whole grid with masks, on the same configuration
+
+def mandelbrot_masks(xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon=2.0):
+    C = mandelbrot_grid(xmin, xmax, ymin, ymax, xn, yn)
+    N = np.zeros_like(C, dtype=int)
+    Z = np.zeros_like(C)
+    for n in range(maxiter):
+        I = abs(Z) < horizon
+        N[I] = n
+        Z[I] = Z[I]**2 + C[I]
+    N[N == maxiter-1] = 0
+    return Z, N
+
+for function in (mandelbrot_masks, mandelbrot_set):
+    start = time.perf_counter()
+    function(xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon)
+    print(f'{function.__name__:>16}: {time.perf_counter() - start:.2f}s')
+# e.g. -> mandelbrot_masks: 2.74s
+#           mandelbrot_set: 0.70s
+
+
+#%% Speedup of the tiled, multi-process rendering vs the number of cores,
+#   for the full 3000x2500 resolution. (Where processes are spawned, call it
+# from a script, under if __name__ == '__main__':)
+
+def speedup_benchmark(xn=3000, yn=2500):
+    view = xmin, xmax, ymin, ymax, xn, yn, maxiter, horizon
+    start = time.perf_counter()
+    mandelbrot_set(*view)
+    single = time.perf_counter() - start
+    print(f'{"1 process":>12}: {single:.2f}s')
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        start = time.perf_counter()
+        mandelbrot_set(*view, tiles=16 * workers, workers=workers)
+        elapsed = time.perf_counter() - start
+        print(f'{workers:2} worker(s): {elapsed:.2f}s, '
+              f'speedup {single / elapsed:.2f}')
+
+#speedup_benchmark()
+
+
+#%% Streaming a large render to a file, tile by tile, with bounded memory,
+#   then displaying it (subsampled) from the memory-mapped file
+
+import tempfile
+import tracemalloc
+
+def stream_demo(xn=6000, yn=5000, step=4):
+    with tempfile.TemporaryDirectory() as directory:   # (then deleted)
+        path = os.path.join(directory, 'mandelbrot.npy')
+        tracemalloc.start()
+        M = mandelbrot_stream(path, xmin, xmax, ymin, ymax, xn, yn, maxiter,
+                              horizon, smooth=True)
+        print(f'{M.nbytes / 2**20:.0f} MB file, '
+              f'{tracemalloc.get_traced_memory()[1] / 2**20:.0f} MB peak')
+        tracemalloc.stop()
+        del M
+        M = np.load(path, mmap_mode='r')
+        plt.imshow(M[::step, ::step], cmap=plt.cm.hot,
+                   norm=colors.PowerNorm(0.3), extent=[xmin, xmax, ymin, ymax])
+        plt.show()
+        del M                           # (close the file first)
+
+#stream_demo()
+# e.g. -> 114 MB file, 37 MB peak
+
+
+#%% Deep zooms: with float32 (or even float64) coordinates, neighbour pixels
+#   become equal past a zoom of about 1e-6 (or 1e-15). With perturbations,
+# only one reference orbit X, of the centre C, is computed in high precision
+# (here with Decimal) and, for each pixel c = C + dc, only its difference d
+# to it, in float64 (as z = X + d):   d' = 2 X d + d**2 + dc
+# The first iterations can even be skipped, approximating d by a series in
+# dc as long as it is accurate (checked here on a few probe pixels). Pixels
+# whose z gets much smaller than X lose all precision ("glitches"), and so
+# are computed again with another reference orbit, taken among them.
+
+import warnings
+from decimal import Decimal, localcontext
+
+def reference_orbit(cx, cy, maxiter, horizon, digits):
+    orbit = [0j]
+    with localcontext() as context:
+        context.prec = digits
+        x = y = Decimal(0)
+        horizon2 = Decimal(horizon) ** 2
+        for n in range(maxiter):
+            x, y = x*x - y*y + cx, 2*x*y + cy
+            orbit.append(complex(x, y))
+            if x*x + y*y >= horizon2: break
+    return np.array(orbit)
+
+def series_skip(orbit, probes, horizon, tolerance=1e-12):
+    '''Return how many iterations can be skipped, and the series terms'''
+    A, B, C = 0j, 0j, 0j                # d = A dc + B dc**2 + C dc**3
+    d = np.zeros_like(probes)           # exact d for the probes
+    r = abs(probes).max()               # (the corners are the farthest)
+    for n in range(len(orbit) - 1):
+        X = orbit[n]
+        A, B, C, a, b, c = 2*X*A + 1, 2*X*B + A*A, 2*X*C + 2*A*B, A, B, C
+        d = 2*X*d + d*d + probes
+        error = abs(A*probes + B*probes**2 + C*probes**3 - d)
+        if (error > tolerance * abs(d)).any() or abs(orbit[n+1]) + \
+                abs(A)*r + abs(B)*r**2 + abs(C)*r**3 >= horizon:
+            return n, (a, b, c)         # (no pixel escaped before n)
+    return len(orbit) - 1, (A, B, C)
+
+def perturbation(orbit, index, d, dc, start, maxiter, horizon, Z, N):
+    '''Iterate the pixels from start, return those with glitches'''
+    glitches = []
+    for n in range(start, min(maxiter, len(orbit) - 1)):
+        d *= 2 * orbit[n] + d           # d = 2 X d + d**2 + dc
+        d += dc
+        z = orbit[n+1] + d
+        r = z.real**2 + z.imag**2
+        out = r >= horizon**2
+        glitch = r < 1e-6 * abs(orbit[n+1])**2
+        if out.any() or glitch.any():
+            N[index[out]] = n
+            Z[index[out]] = z[out]
+            glitches.append(index[glitch & ~out])
+            keep = ~(out | glitch)
+            index, d, dc = index[keep], d[keep], dc[keep]
+            if not index.size: break
+    else:
+        if len(orbit) - 1 < maxiter:    # the reference escaped first
+            glitches.append(index)
+        else:
+            Z[index] = orbit[maxiter] + d
+    return np.concatenate(glitches) if glitches else index[:0]
+
+def mandelbrot_deep(x, y, width, xn, yn, maxiter, horizon=2.0,
+                    references=10):
+    '''Return Z, N for a view of given width, centred on x+yj (strings)'''
+    digits = max(20, 20 - int(np.log10(width)))
+    height = width * yn / xn
+    dx = np.linspace(-width / 2, width / 2, xn)
+    dy = np.linspace(-height / 2, height / 2, yn)
+    DC = (dx + dy[:, None] * 1j).ravel()
+    Z = np.zeros_like(DC)
+    N = np.zeros(DC.size, dtype=int)
+    index, shift = np.arange(DC.size), 0j
+    for reference in range(references):
+        with localcontext() as context:
+            context.prec = digits
+            cx = Decimal(x) + Decimal(shift.real)
+            cy = Decimal(y) + Decimal(shift.imag)
+        orbit = reference_orbit(cx, cy, maxiter, horizon, digits)
+        dc = DC[index] - shift
+        if reference == 0:              # then dc of the corners etc.
+            probes = np.array([DC[0], DC[xn-1], DC[-xn], DC[-1],
+                               DC[xn//2], DC[-xn//2], dx[0], dx[-1]])
+            start, (A, B, C) = series_skip(orbit, probes, horizon)
+            d = A*dc + B*dc**2 + C*dc**3
+        else:
+            start, d = 0, np.zeros_like(dc)
+        index = perturbation(orbit, index, d, dc, start, maxiter, horizon,
+                             Z, N)
+        if not index.size: break
+        shift = DC[index[len(index) // 2]]
+    if index.size:                      # (left with N = 0, as if inside)
+        warnings.warn(f'{index.size} pixels still glitched after '
+                      f'{references} reference orbits')
+    N[N == maxiter-1] = 0
+    return Z.reshape(yn, xn), N.reshape(yn, xn)
+
+# Deep zoom locations with (exact) regression checks, comparing the escape
+# counts of random pixels with those computed entirely with Decimal numbers
+# (near the boundary, long orbits are chaotic: even float64 rounding errors
+# can change their escape counts, which shows in the shallow zoom below)
+DEEP_ZOOMS = [
+    ('Misiurewicz point i', '0', '1', 1e-30, 1000),
+    ('Tip of the antenna', '-2', '0', 1e-30, 1000),
+    ('Misiurewicz point M3,1', '-1.543689012692076361570855971801748',
+                               '0', 1e-30, 1000),
+    ('Seahorse valley', '-0.743643887037158704752191506114774',
+                        '0.131825904205311970493132056385139', 1e-25, 20000),
+    ('Seahorse valley (shallow)', '-0.743643887037158704752191506114774',
+                                  '0.131825904205311970493132056385139',
+                                  1e-10, 2000)]
+
+def escape_count(cx, cy, maxiter, horizon, digits):
+    with localcontext() as context:
+        context.prec = digits
+        x = y = Decimal(0)
+        for n in range(maxiter):
+            x, y = x*x - y*y + cx, 2*x*y + cy
+            if x*x + y*y >= Decimal(horizon) ** 2:
+                return n
+    return 0
+
+def deep_zoom_regression(xn=160, yn=120, horizon=2.0 ** 8, samples=20,
+                         seed=0):
+    random = np.random.default_rng(seed)    # (the same pixels every time)
+    for name, x, y, width, maxiter in DEEP_ZOOMS:
+        start = time.perf_counter()
+        Z, N = mandelbrot_deep(x, y, width, xn, yn, maxiter, horizon)
+        elapsed = time.perf_counter() - start
+        digits = max(20, 20 - int(np.log10(width)))
+        dx = np.linspace(-width / 2, width / 2, xn)
+        dy = np.linspace(-width * yn / xn / 2, width * yn / xn / 2, yn)
+        errors, start = 0, time.perf_counter()
+        for i, j in zip(random.integers(yn, size=samples),
+                        random.integers(xn, size=samples)):
+            with localcontext() as context:
+                context.prec = digits
+                cx = Decimal(x) + Decimal(dx[j])
+                cy = Decimal(y) + Decimal(dy[i])
+            errors += N[i, j] != escape_count(cx, cy, maxiter, horizon, digits)
+        exact = (time.perf_counter() - start) / samples
+        print(f'{name:>26}: {elapsed / (xn * yn) * 1e6:6.1f} us/pixel '
+              f'(Decimal: {exact * 1e6:8.0f} us), {errors}/{samples} errors')
+
+#deep_zoom_regression()
+# e.g. -> Misiurewicz point i:   0.8 us/pixel (Decimal:   454 us), 0/20 errors
+#              Seahorse valley: 244.7 us/pixel (Decimal: 53675 us), 0/20 errors
+
+deep_horizon = 2.0 ** 8
+Z, N = mandelbrot_deep('0', '1', 1e-30, 800, 600, 1000, deep_horizon)
+plt.imshow(smooth_count(Z, N, deep_horizon), cmap=plt.cm.hot,
+           norm=colors.PowerNorm(0.3))
+plt.title('Zoom x 1e30 around c = i')
+plt.show()
+
+
+#%% Interactive exploration: panning or raising maxiter should not compute
+#   everything again. The plane is divided into tiles of pixels, on a fixed
+# grid for each pixel size, which keep their Z and N, and the points still
+# iterating: so raising maxiter resumes from where it stopped, and panning
+# only computes the new tiles. Tiles are kept in a cache (the least recently
+# used are evicted). For a fast first display, views are rendered coarse to
+# fine: with 1/16, then 1/4, then all the pixels (and zooming in by 2 finds
+# the tiles of a coarser render already computed!)
+
+from collections import OrderedDict
+
+class MandelbrotTiles:
+    def __init__(self, tile=64, tiles=1024, horizon=2.0):
+        self.tile, self.tiles, self.horizon = tile, tiles, horizon
+        self.cache = OrderedDict()      # (scale, i, j): [C, Z, N, index, n]
+        self.hits = self.resumed = self.misses = 0
+
+    def get(self, scale, i, j, maxiter):
+        key = scale, i, j
+        state = self.cache.pop(key, None)
+        if state is not None and state[4] > maxiter:
+            state = None                # Z went too far: start again
+        if state is None:
+            self.misses += 1
+            X = (i * self.tile + np.arange(self.tile)) * scale
+            Y = (j * self.tile + np.arange(self.tile)) * scale
+            C = (X + Y[:, None] * 1j).astype(np.complex64).ravel()
+            state = [C, np.zeros_like(C), np.zeros(C.size, dtype=int),
+                     np.arange(C.size), 0]
+        elif state[4] < maxiter and state[3].size:
+            self.resumed += 1
+        else:
+            self.hits += 1
+        C, Z, N, index, iterations = state
+        if iterations < maxiter:        # resume where it stopped
+            state[3] = escape_iterate(C, Z, N, index, iterations, maxiter,
+                                      self.horizon)
+            state[4] = maxiter
+        self.cache[key] = state         # (now the most recently used)
+        if len(self.cache) > self.tiles:
+            self.cache.popitem(last=False)
+        return state
+
+    def render(self, x, y, scale, xn, yn, maxiter):
+        '''Return Z, N of xn x yn pixels of given size from (about) x+yj'''
+        T = self.tile
+        x0, y0 = round(x / scale), round(y / scale)     # in pixels
+        Z = np.zeros((yn, xn), np.complex64)
+        N = np.zeros((yn, xn), int)
+        for j in range(y0 // T, (y0 + yn - 1) // T + 1):
+            for i in range(x0 // T, (x0 + xn - 1) // T + 1):
+                C, Zt, Nt, index, _ = self.get(scale, i, j, maxiter)
+                Nt = Nt.copy()
+                Nt[index] = 0           # not escaped (yet)
+                Nt[Nt >= maxiter-1] = 0
+                rows = slice(max(j*T, y0), min(j*T + T, y0 + yn))
+                cols = slice(max(i*T, x0), min(i*T + T, x0 + xn))
+                tile = (slice(rows.start - j*T, rows.stop - j*T),
+                        slice(cols.start - i*T, cols.stop - i*T))
+                view = (slice(rows.start - y0, rows.stop - y0),
+                        slice(cols.start - x0, cols.stop - x0))
+                Z[view] = Zt.reshape(T, T)[tile]
+                N[view] = Nt.reshape(T, T)[tile]
+        return Z, N
+
+    def progressive(self, x, y, scale, xn, yn, maxiter, steps=(4, 2, 1)):
+        '''Yield renders of the view from coarse to fine'''
+        for step in steps:
+            Z, N = self.render(x, y, scale * step, -(-xn // step),
+                               -(-yn // step), maxiter)
+            yield (Z.repeat(step, 0).repeat(step, 1)[:yn, :xn],
+                   N.repeat(step, 0).repeat(step, 1)[:yn, :xn])
+
+tiles = MandelbrotTiles(horizon=horizon)
+scale = (xmax - xmin) / xn
+for name, x, iterations in (('first render', xmin, maxiter),
+                            ('pan by 100 pixels', xmin + 100*scale, maxiter),
+                            ('maxiter x 2', xmin + 100*scale, 2*maxiter)):
+    start = time.perf_counter()
+    for Z, N in tiles.progressive(x, ymin, scale, xn, yn, iterations):
+        print(f'{name:>18}: {time.perf_counter() - start:.2f}s, '
+              f'{tiles.misses} new, {tiles.resumed} resumed, '
+              f'{tiles.hits} cached tiles')
+
+plt.imshow(smooth_count(Z, N, horizon), cmap=plt.cm.hot, origin='lower',
+           norm=colors.PowerNorm(0.3))
+plt.show()
+
+
 #%% 3D surface demo
 
 from matplotlib import cm
@@ -28,8 +28,9 @@
 ##  10. Reflection and Meta-programming
 ##  11. Modules and Libraries in Python
 ##  12. Graphics and GUI Extensions
-##  13. Threads and Concurrency: simple threads, subclassing, timer threads,
-##                          more examples, coroutines, asynchronous generators
+##  13. Threads and Concurrency: simple threads, subclassing, thread pools,
+##                          timer threads, more examples, coroutines,
+##                          asynchronous generators
 ##  14. Miscellanies and References
 ##  15. Scientific Python
 ##
@@ -62,13 +63,19 @@ import random
 #   a number of threads, sets simpleTask() as their target/run function,
 # then start each, which initializes the thread and calls its run method
 
-def ten_little_threads(number = 10):
-
-    def simple_task(thread_id, waiting_time):
-        # do something ...
-        print(f" thread {thread_id} sleeping ({waiting_time}) ")
-        time.sleep(waiting_time)
-        print(f" thread {thread_id} awaking ")
+def simple_task(thread_id, waiting_time):
+    # do something ...
+    print(f" thread {thread_id} sleeping ({waiting_time}) ")
+    time.sleep(waiting_time)
+    print(f" thread {thread_id} awaking ")
+
+def ten_little_threads(number = 10, workers = None, backend = 'thread'):
+    if workers:                                 # pool mode (see below)
+        with executor(backend, workers) as pool:
+            for num in range(number):
+                print(f" task {num} submitted ")
+                pool.submit(simple_task, num, random.randint(1,10))
+        return
 
     for num in range(number):
         print(f" thread {num} starting ")
@@ -77,6 +84,8 @@ def ten_little_threads(number = 10):
         t.start()
 
 #ten_little_threads()
+#ten_little_threads(workers=3)
+#ten_little_threads(workers=3, backend='process')
 
 
 #%% Thread subclass, overrides the run() method instead
@@ -94,13 +103,197 @@ class simple_thread(threading.Thread):
         print(f' thread {self.args[0]} awaking ')
         return
 
-def more_little_threads(number = 10):
+def more_little_threads(number = 10, workers = None):
+    if workers:                     # the pool calls run() directly, so the
+        with WorkerPool(workers) as pool:       # threads are never started
+            for num in range(number):
+                t = simple_thread(args=(num, random.randint(1,10)))
+                pool.submit(t.run)
+        return
+
     for num in range(number):
         print(f' thread {num} starting ')
         t = simple_thread(args=(num, random.randint(1,10)))
         t.start()
 
 #more_little_threads()
+#more_little_threads(workers=3)
+
+
+
+################################
+##
+##  THREAD POOLS
+##
+
+
+#%% Starting one new thread per task is fine for ten little threads, but not
+#   for tens of thousands of them: each costs a thread creation and its own
+# stack (see the coroutines section below). A thread pool instead starts a
+# fixed number of worker threads once, which then take tasks from a shared
+# queue. Each submitted task immediately returns a Future, a placeholder for
+# the result (or exception) to come.
+#
+# The standard library provides concurrent.futures.ThreadPoolExecutor; the
+# following is a minimal version of it, implementing the same Executor
+# interface (submit, map, shutdown, and 'with' statement support).
+import queue
+from concurrent.futures import Executor, Future
+
+class WorkerPool(Executor):
+    '''Fixed number of worker threads executing tasks from a shared queue'''
+
+    def __init__(self, workers=4):
+        self._tasks = queue.SimpleQueue()
+        self._shutdown = False
+        self._shutdown_lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for w in self._workers: w.start()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None: return             # sentinel: time to stop
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel(): continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit tasks after shutdown')
+            future = Future()
+            self._tasks.put((future, fn, args, kwargs))
+            return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._shutdown_lock:
+            if not self._shutdown:
+                self._shutdown = True
+                if cancel_futures:              # drop the pending tasks
+                    while True:
+                        try: task = self._tasks.get_nowait()
+                        except queue.Empty: break
+                        if task is not None: task[0].cancel()
+                for _ in self._workers:         # one sentinel per worker,
+                    self._tasks.put(None)       # queued after all tasks
+        if wait:
+            for w in self._workers: w.join()
+
+def pool_demo(workers=4):
+    def square(x):
+        time.sleep(0.1)
+        return x * x
+    with WorkerPool(workers) as pool:
+        futures = [pool.submit(square, n) for n in range(10)]
+        print([f.result() for f in futures])    # wait for each result
+        print(list(pool.map(square, range(10))))
+
+#pool_demo()
+
+
+#%% Comparing throughput (tasks/second) and peak memory (RSS) of one thread
+#   per task vs. a pool. Each variant runs in a fresh process so that the
+# peak memory of one does not hide that of the other. (The resource module
+# is Unix-only; elsewhere the memory is not reported.)
+import multiprocessing
+
+def tiny_task(n):
+    time.sleep(0.001)                   # a short wait, e.g. some I/O
+    return n
+
+def _spawn_tasks(tasks, workers):
+    threads = [threading.Thread(target=tiny_task, args=(n,))
+               for n in range(tasks)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+def _pool_tasks(tasks, workers):
+    with WorkerPool(workers) as pool:
+        for n in range(tasks): pool.submit(tiny_task, n)
+
+def _measure(run, tasks, workers, results):
+    start = time.perf_counter()
+    run(tasks, workers)
+    elapsed = time.perf_counter() - start
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # in KB
+    except ImportError:
+        peak = None
+    results.put((tasks / elapsed, peak))
+
+def pool_benchmark(tasks=20000, workers=32):
+    results = multiprocessing.Queue()
+    for name, run in (('thread per task', _spawn_tasks),
+                      (f'pool of {workers}', _pool_tasks)):
+        p = multiprocessing.Process(target=_measure,
+                                    args=(run, tasks, workers, results))
+        p.start()
+        rate, peak = results.get()
+        p.join()
+        print(f'{name:>16}: {rate:10.0f} tasks/s, peak RSS {peak} KB')
+
+#pool_benchmark()
+
+
+#%% Threads vs. processes: because of the Global Interpreter Lock (GIL, see
+#   below) only one thread at a time executes Python code. Threads are thus
+# great for tasks that mostly wait (sleep, I/O) but give no speedup at all to
+# CPU-bound tasks. For these, the work must be spread over several processes
+# instead, each with its own interpreter (and its own GIL).
+#
+# Both kinds of pools share the same Executor interface, so the backend can
+# simply be chosen per call. Note that tasks and their arguments are pickled
+# to be sent to another process, which is why the functions must be defined
+# at the top level of a module, and why tasks are best submitted in chunks,
+# to amortize this overhead. (On Windows and macOS, processes are spawned
+# rather than forked, which also requires running this file as a script.)
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+EXECUTORS = {'thread': WorkerPool, 'process': ProcessPoolExecutor}
+
+def executor(backend='thread', workers=None):
+    '''Return a new pool of workers, either threads or processes'''
+    if backend not in EXECUTORS:
+        raise ValueError(f'unknown backend {backend!r}')
+    return EXECUTORS[backend](workers or os.cpu_count() or 1)
+
+def run_tasks(fn, args, backend='thread', workers=None, chunksize=None):
+    '''Apply fn to each of the args in parallel, return the results in order'''
+    args = list(args)
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:               # a few chunks per worker, so that
+        chunksize = max(1, len(args) // (4 * workers))  # they stay balanced
+    with executor(backend, workers) as pool:
+        return list(pool.map(fn, args, chunksize=chunksize))
+
+def fib(n):                             # CPU-bound, cf. section 04
+    return n if n < 2 else fib(n-1) + fib(n-2)
+
+#run_tasks(fib, range(25), backend='process')
+
+
+#%% Scaling benchmark: the same CPU-bound work spread over 1..N workers. The
+#   speedup with threads stays around 1 whereas it grows (almost linearly)
+# with the number of cores when using processes.
+def scaling_benchmark(n=24, tasks=64, max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    for backend in EXECUTORS:
+        for workers in range(1, max_workers + 1):
+            start = time.perf_counter()
+            run_tasks(fib, [n] * tasks, backend, workers)
+            elapsed = time.perf_counter() - start
+            if workers == 1: base = elapsed
+            print(f'{backend:>7} x {workers:2}: {elapsed:6.2f} s,'
+                  f' speedup {base / elapsed:5.2f}')
+
+#scaling_benchmark()
 
 
 
@@ -115,9 +308,9 @@ def delayed_task(task_name):
     print('task', task_name, 'working')
     return
 
-def little_timers(sleep_time=4):
-    t1 = threading.Timer(2, delayed_task, args=('t1',))
-    t2 = threading.Timer(6, delayed_task, args=('t2',))
+def little_timers(sleep_time=4, timer=threading.Timer):
+    t1 = timer(2, delayed_task, args=('t1',))
+    t2 = timer(6, delayed_task, args=('t2',))
     print('starting timers')
     t1.start()
     t2.start()
@@ -125,6 +318,243 @@ def little_timers(sleep_time=4):
     t2.cancel()                 # if sleep_time > 6, task #2 will never run
 
 #little_timers()
+#little_timers(timer=WheelTimer)
+
+
+#%% Each Timer is a thread of its own, which sleeps until it is time to run
+#   its task. That is a lot of threads (and memory) for hundreds of thousands
+# of delayed tasks! A timer wheel instead uses a single thread: time is cut
+# into ticks, and the wheel is an array of slots, one per tick, going round
+# and round. A task due in k ticks is put in slot (current + k) % slots, in
+# O(1), and cancelling it just removes it from its slot, in O(1) too. At each
+# tick, the thread runs, in one batch, all the tasks of the current slot that
+# are due (a slot also holds tasks due one or more turns of the wheel later).
+# The price to pay: tasks run up to one tick late, i.e. the wheel's drift.
+import math
+import statistics
+from collections import deque
+
+class TimerHandle:
+    '''A task scheduled on a TimerWheel, which can be cancelled'''
+    __slots__ = ('wheel', 'due', 'tick', 'function', 'args', 'kwargs')
+
+    def __init__(self, wheel, due, tick, function, args, kwargs):
+        self.wheel, self.due, self.tick = wheel, due, tick
+        self.function, self.args, self.kwargs = function, args, kwargs
+
+    def cancel(self):
+        return self.wheel.cancel(self)
+
+class TimerWheel:
+    '''Single thread running any number of delayed tasks, tick by tick'''
+
+    def __init__(self, tick=0.01, slots=1024):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.origin = time.monotonic()
+        self.current = 0                # number of ticks elapsed so far
+        self.pending = 0
+        self.fired = 0
+        self.drifts = deque(maxlen=10000)   # most recent delays in running
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay, function, *args, **kwargs):
+        '''Run function(*args, **kwargs) in delay seconds, return a handle'''
+        due = time.monotonic() + delay
+        with self.lock:
+            tick = max(self.current + 1,
+                       math.ceil((due - self.origin) / self.tick))
+            handle = TimerHandle(self, due, tick, function, args, kwargs)
+            self.slots[tick % len(self.slots)][id(handle)] = handle
+            self.pending += 1
+        self.wakeup.set()
+        return handle
+
+    def cancel(self, handle):
+        '''Cancel a scheduled task, return False if it already ran'''
+        with self.lock:
+            if self.slots[handle.tick % len(self.slots)].pop(id(handle), None):
+                self.pending -= 1
+                return True
+        return False
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+
+    def _run(self):
+        while self.running:
+            self.wakeup.clear()
+            if not self.pending:        # nothing to do, until a schedule()
+                self.wakeup.wait()
+            delay = self.origin + (self.current+1)*self.tick - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            self._expire()
+
+    def _expire(self):
+        expired = []
+        now = int((time.monotonic() - self.origin) / self.tick)
+        with self.lock:                 # catch up with all elapsed ticks,
+            last = min(now, self.current + len(self.slots))  # once per slot
+            for tick in range(self.current + 1, last + 1):
+                slot = self.slots[tick % len(self.slots)]
+                due = [h for h in slot.values() if h.tick <= now]
+                for h in due: del slot[id(h)]
+                expired.extend(due)
+            self.current = max(self.current, now)
+            self.pending -= len(expired)
+        for h in expired:               # run the batch, outside of the lock
+            self.drifts.append(time.monotonic() - h.due)
+            self.fired += 1
+            try:
+                h.function(*h.args, **h.kwargs)
+            except Exception as exc:
+                print(f'timer task {h.function.__name__} failed: {exc!r}')
+
+    def stats(self):
+        drifts = sorted(self.drifts) or [0.0]
+        return {'pending': self.pending, 'fired': self.fired,
+                'mean drift': statistics.fmean(drifts),
+                'p99 drift': drifts[int(0.99 * (len(drifts) - 1))],
+                'max drift': drifts[-1]}
+
+class WheelTimer:
+    '''Drop-in replacement for threading.Timer, using a shared TimerWheel'''
+    wheel = None
+
+    def __init__(self, interval, function, args=None, kwargs=None):
+        self.interval, self.function = interval, function
+        self.args, self.kwargs = args or (), kwargs or {}
+        self.handle = None
+
+    def start(self):
+        if WheelTimer.wheel is None: WheelTimer.wheel = TimerWheel()
+        self.handle = self.wheel.schedule(self.interval, self.function,
+                                          *self.args, **self.kwargs)
+
+    def cancel(self):
+        if self.handle: self.handle.cancel()
+
+#little_timers(timer=WheelTimer) ; WheelTimer.wheel.stats()
+
+
+#%% Benchmark: schedule then cancel 10k/100k timers, one thread each vs. one
+#   timer wheel. The memory measured by tracemalloc is that of the Python
+# objects only, not counting the stacks of the threads (see below).
+import tracemalloc
+
+def _run_timers(timer, count, delay, trace):
+    if trace: tracemalloc.start()
+    timers = []
+    start = time.perf_counter()
+    try:
+        for _ in range(count):
+            t = timer(delay, delayed_task, args=('late',))
+            t.start()
+            timers.append(t)
+    except RuntimeError as exc:         # e.g. can't start new thread
+        print(f'  {timer.__name__} failed after {len(timers)}: {exc}')
+    scheduled = time.perf_counter()
+    memory = tracemalloc.get_traced_memory()[0] if trace else None
+    if trace: tracemalloc.stop()
+    for t in timers: t.cancel()
+    cancelled = time.perf_counter()
+    for t in timers:
+        if isinstance(t, threading.Thread): t.join()
+    n = max(1, len(timers))
+    if trace: memory /= n
+    return (scheduled-start) / n, (cancelled-scheduled) / n, memory
+
+def timer_benchmark(counts=(10_000, 100_000), delay=60):
+    for count in counts:
+        for timer in (threading.Timer, WheelTimer):
+            WheelTimer.wheel = TimerWheel()
+            schedule, cancel, _ = _run_timers(timer, count, delay, False)
+            _, _, memory = _run_timers(timer, count, delay, True)
+            WheelTimer.wheel.stop()
+            print(f'{count:7} x {timer.__name__:>10}:'
+                  f' schedule {schedule*1e6:7.2f} us,'
+                  f' cancel {cancel*1e6:6.2f} us, {memory:7.0f} bytes each')
+
+#timer_benchmark()
+
+
+
+################################
+##
+##  INSTRUMENTED LOCKS
+##
+
+
+#%% Where do threads spend their time waiting? A lock can record it: how
+#   often it is acquired, how often it was already taken (contention), and
+# for how long threads waited for it and then held it. Checking first with a
+# non-blocking acquire costs next to nothing, and only contended acquisitions
+# are timed. To lower the overhead further, only 1 out of every sample
+# acquisitions is timed; the totals are then estimated from these. (Counts
+# are updated without any extra locking, so they may be slightly off.)
+
+class InstrumentedLock:
+    '''Drop-in replacement for threading.Lock, recording contention'''
+    registry = {}                       # all locks, by name
+
+    def __init__(self, name=None, sample=1):
+        self.name = name or f'lock {len(self.registry)}'
+        self.sample = sample
+        self._lock = threading.Lock()
+        self._since = None              # when acquired, if timed
+        self.acquisitions = self.contentions = self.failures = 0
+        self.waits = self.holds = 0     # number of timed waits and holds
+        self.wait_time = self.hold_time = 0.0
+        InstrumentedLock.registry[self.name] = self
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self._lock.acquire(False):
+            self.contentions += 1
+            timed = self.contentions % self.sample == 0
+            start = time.perf_counter() if timed else 0
+            if not (blocking and self._lock.acquire(True, timeout)):
+                self.failures += 1      # try-acquire failed, or timeout
+                return False
+            if timed:
+                self.wait_time += time.perf_counter() - start
+                self.waits += 1
+        self.acquisitions += 1
+        if self.acquisitions % self.sample == 0:
+            self._since = time.perf_counter()
+        return True
+
+    def release(self):
+        if self._since is not None:
+            self.hold_time += time.perf_counter() - self._since
+            self.holds += 1
+            self._since = None
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @classmethod
+    def report(cls, locks=None):
+        print(f'{"lock":>12} {"acquired":>9} {"contended":>9} {"failed":>7}'
+              f' {"total wait":>11} {"mean wait":>10} {"mean hold":>10}')
+        for lock in locks or cls.registry.values():
+            wait = lock.wait_time / lock.waits if lock.waits else 0.0
+            hold = lock.hold_time / lock.holds if lock.holds else 0.0
+            waited = lock.contentions - lock.failures   # blocking waits
+            print(f'{lock.name:>12} {lock.acquisitions:9} {lock.contentions:9}'
+                  f' {lock.failures:7} {wait * waited:10.4f}s'
+                  f' {wait*1e6:8.1f}us {hold*1e6:8.1f}us')
 
 
 
@@ -141,21 +571,37 @@ def little_timers(sleep_time=4):
 
 class Philosopher(threading.Thread):
     running = True
+    stopping = threading.Event()        # wakes them up when running ends
+    thinking = (3, 13)                  # ranges of durations, in seconds
+    eating = (1, 10)
+    verbose = True
 
-    def __init__(self, name, forkOnLeft, forkOnRight):
+    def __init__(self, name, forkOnLeft, forkOnRight,
+                 mode='swap', waiter=None, stats=None):
         threading.Thread.__init__(self)
         self.name = name
         self.forkOnLeft = forkOnLeft
         self.forkOnRight = forkOnRight
+        self.mode = mode
+        self.waiter = waiter
+        self.stats = stats or DiningStats()
+
+    def say(self, message):
+        if self.verbose: print(message)
 
     def run(self):
         while(self.running):
             # The philosopher is thinking (in reality he's sleeping)
-            time.sleep( random.uniform(3,13))
-            print(f'{self.name} is hungry.')
+            self.stopping.wait(random.uniform(*self.thinking))
+            if not self.running: break      # deadline passed while thinking
+            self.say(f'{self.name} is hungry.')
+            self.hungry = time.perf_counter()
             self.dine()
 
-    def dine(self):
+    def dine(self):                     # dispatch on the arbitration mode
+        getattr(self, 'dine_' + self.mode)()
+
+    def dine_swap(self):
         fork1, fork2 = self.forkOnLeft, self.forkOnRight
 
         while self.running:
@@ -163,7 +609,7 @@ class Philosopher(threading.Thread):
             locked = fork2.acquire(False)
             if locked: break
             fork1.release()
-            print(f'{self.name} swaps forks')
+            self.say(f'{self.name} swaps forks')
             fork1, fork2 = fork2, fork1
         else: return
 
@@ -171,26 +617,142 @@ class Philosopher(threading.Thread):
         fork2.release()
         fork1.release()
 
-    def dining(self):
-        print(f'{self.name} starts eating ')
-        time.sleep(random.uniform(1,10))
-        print(f'{self.name} finishes eating and leaves to think.')
+    def dine_ordered(self):
+        fork1, fork2 = sorted((self.forkOnLeft, self.forkOnRight), key=id)
+        fork1.acquire(True)
+        fork2.acquire(True)
+        self.dining()
+        fork2.release()
+        fork1.release()
+
+    def dine_waiter(self):
+        self.waiter.sit()
+        try:
+            self.forkOnLeft.acquire(True)
+            self.forkOnRight.acquire(True)
+            self.dining()
+            self.forkOnRight.release()
+            self.forkOnLeft.release()
+        finally:
+            self.waiter.leave()
 
-def DiningPhilosophers():
-    forks = [threading.Lock() for n in range(5)]
+    def dining(self):
+        if not self.running: return     # got the forks, but too late
+        self.stats.meal(self.name, time.perf_counter() - self.hungry)
+        self.say(f'{self.name} starts eating ')
+        self.stopping.wait(random.uniform(*self.eating))
+        self.say(f'{self.name} finishes eating and leaves to think.')
+
+
+#%% The swap strategy above never deadlocks, but philosophers may keep on
+#   picking up and putting down forks without eating (livelock), burning CPU
+# while doing so. Two classic alternatives avoid this altogether:
+# - resource ordering: each philosopher always picks up first the fork that
+#   comes first in some global order (here, their ids), so that no cycle of
+#   philosophers waiting for each other can ever form;
+# - arbitrator: a waiter lets at most n-1 philosophers sit at the table at
+#   once, so that at least one of them can get both forks. Serving them in
+#   order of arrival also guarantees that nobody starves.
+
+class Waiter:
+    '''Seats at most a number of philosophers, in order of arrival'''
+
+    def __init__(self, seats):
+        self.seats = seats
+        self.condition = threading.Condition()
+        self.next_ticket = 0            # ticket of the next one to arrive
+        self.serving = 0                # ticket of the next one to be seated
+
+    def sit(self):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.condition.wait_for(
+                lambda: self.serving == ticket and self.seats > 0)
+            self.serving += 1
+            self.seats -= 1
+            self.condition.notify_all()
+
+    def leave(self):
+        with self.condition:
+            self.seats += 1
+            self.condition.notify_all()
+
+from collections import Counter
+
+class DiningStats:
+    '''Meals eaten, and waiting times from hungry to eating'''
+
+    def __init__(self, target=None):
+        self.lock = threading.Lock()
+        self.meals = Counter()
+        self.waits = []
+        self.target = target            # total number of meals to serve
+        self.done = threading.Event()
+
+    def meal(self, name, wait):
+        with self.lock:
+            self.meals[name] += 1
+            self.waits.append(wait)
+            if self.target and len(self.waits) >= self.target:
+                self.done.set()
+
+    def report(self, elapsed, philosophers, forks):
+        meals = len(self.waits)
+        print(f'{meals} meals in {elapsed:.2f} s'
+              f' = {meals / elapsed:.1f} meals/s')
+        if meals > 1:
+            q = statistics.quantiles(self.waits, n=100, method='inclusive')
+            print(f'wait time: p50 {q[49]:.4f} s, p90 {q[89]:.4f} s,'
+                  f' p99 {q[98]:.4f} s, max {max(self.waits):.4f} s')
+        eaten = [self.meals[p.name] for p in philosophers]
+        print(f'meals per philosopher: {min(eaten)} to {max(eaten)}')
+        InstrumentedLock.report(forks)
+
+def DiningPhilosophers(n=5, mode='swap', meals=None, duration=100,
+                       think=(3, 13), eat=(1, 10), verbose=True, sample=1):
+    if not hasattr(Philosopher, 'dine_' + mode):
+        raise ValueError(f'unknown mode {mode!r}')
+    if n < 2:                           # (a single fork cannot be two)
+        raise ValueError(f'at least 2 philosophers are needed, not {n}')
+    forks = [InstrumentedLock(f'fork {i}', sample) for i in range(n)]
     philosopherNames = ('Aristotle', 'Kant', 'Plato', 'Marx', 'Russel')
+    names = [philosopherNames[i] if n <= 5 else
+             f'{philosopherNames[i%5]} {i//5 + 1}' for i in range(n)]
+    waiter = Waiter(n - 1) if mode == 'waiter' else None
+    stats = DiningStats(meals)
 
-    philosophers= [Philosopher(philosopherNames[i], forks[i%5], forks[(i+1)%5]) \
-            for i in range(5)]
+    philosophers= [Philosopher(names[i], forks[i%n], forks[(i+1)%n],
+                               mode, waiter, stats) for i in range(n)]
 
     random.seed(507129)
     Philosopher.running = True
+    Philosopher.stopping.clear()
+    Philosopher.thinking, Philosopher.eating = think, eat
+    Philosopher.verbose = verbose
+    start = time.perf_counter()
     for p in philosophers: p.start()
-    time.sleep(100)
+    stats.done.wait(duration)           # until enough meals, or deadline
+    elapsed = time.perf_counter() - start
     Philosopher.running = False
+    Philosopher.stopping.set()
     print('Now we are finishing.')
+    for p in philosophers: p.join()
+    stats.report(elapsed, philosophers, forks)
+    return stats
 
 #DiningPhilosophers()
+#DiningPhilosophers(mode='waiter', duration=30)
+
+
+#%% Benchmark: many hungry philosophers, who think and eat very quickly
+def dining_benchmark(n=50, meals=5000, duration=20):
+    for mode in ('swap', 'ordered', 'waiter'):
+        print(f'--- {mode} ---')
+        DiningPhilosophers(n, mode, meals, duration,
+                           think=(0, 0.002), eat=(0, 0.001), verbose=False)
+
+#dining_benchmark()
 
 
 
@@ -324,6 +886,143 @@ def producer_consumer_demo():
 #producer_consumer_demo()
 
 
+#%% The consumer above only keeps a sum and a count. A more useful one keeps
+#   running statistics: count, mean, variance, min/max (cf. minimize), and
+# (approximate) quantiles, from a random sample of the values seen. Updating
+# all these one value at a time, in a Python loop, is slow; instead, each
+# whole batch is summarized at once (fast with numpy, if installed), then
+# merged into the running statistics. The same merge combines the partial
+# statistics computed by parallel workers: this is the parallel version of
+# Welford's online variance algorithm (Chan et al.), cf.
+# https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+try:
+    import numpy as np
+except ModuleNotFoundError:             # works without, only slower
+    np = None
+
+class RunningStats:
+    '''Count, mean, variance, min, max and quantiles of a stream of numbers'''
+
+    def __init__(self, sample_size=1000):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0                   # sum of squared deviations from mean
+        self.min = math.inf
+        self.max = -math.inf
+        self.sample = []                # uniform random sample of values
+        self.sample_size = sample_size
+
+    def add(self, values):
+        '''Add a whole batch (list, array) of values'''
+        batch = RunningStats(self.sample_size)
+        if not hasattr(values, '__getitem__'): values = list(values)  # sets...
+        if np is not None:
+            a = np.asarray(values, dtype=float).ravel()
+            if not a.size: return self
+            batch.count, batch.mean = a.size, float(a.mean())
+            batch.m2 = float(np.square(a - batch.mean).sum())
+            batch.min, batch.max = float(a.min()), float(a.max())
+            k = min(self.sample_size, a.size)
+            batch.sample = a[random.sample(range(a.size), k)].tolist()
+        else:
+            values = list(values)
+            if not values: return self
+            batch.count, batch.mean = len(values), statistics.fmean(values)
+            batch.m2 = math.fsum((x - batch.mean)**2 for x in values)
+            batch.min, batch.max = min(values), max(values)
+            k = min(self.sample_size, len(values))
+            batch.sample = random.sample(values, k)
+        return self.merge(batch)
+
+    def merge(self, other):
+        '''Combine with the statistics of another part of the stream'''
+        count = self.count + other.count
+        if not other.count: return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        if len(self.sample) + len(other.sample) <= self.sample_size:
+            self.sample = self.sample + other.sample
+        else:                           # keep each part in proportion
+            mine = min(len(self.sample),
+                       round(self.sample_size * self.count / count))
+            theirs = min(len(other.sample), self.sample_size - mine)
+            self.sample = (random.sample(self.sample, mine)
+                           + random.sample(other.sample, theirs))
+        self.count = count
+        return self
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def quantile(self, q):
+        '''Approximate q-quantile, 0 <= q <= 1, e.g. 0.5 for the median'''
+        values = sorted(self.sample)
+        if not values: return math.nan  # (no values yet)
+        pos = q * (len(values) - 1)
+        low = math.floor(pos)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+    def __repr__(self):
+        return (f'RunningStats(count={self.count}, mean={self.mean:.4g},'
+                f' stdev={math.sqrt(self.variance()):.4g}, min={self.min},'
+                f' median~{self.quantile(0.5):.4g}, max={self.max})')
+
+def consume_stats():
+    '''Keeps running statistics across lists of numbers sent to it'''
+    stats = RunningStats()
+    while True:
+        data = yield stats
+        stats.add(data)
+
+#consumer = consume_stats() ; next(consumer)
+#for _ in range(10): print(consumer.send(get_data()))
+
+
+#%% Benchmark: values per second, one value at a time (as consume() does, but
+#   also with Welford's update of the variance) vs. whole batches, then by
+# merging the statistics of batches processed in parallel (see thread pools).
+def _one_at_a_time(values):
+    count, mean, m2 = 0, 0.0, 0.0
+    for x in values:
+        count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += delta * (x - mean)
+    return count, mean, m2
+
+def _batch_stats(batch):
+    return RunningStats().add(batch)
+
+def stats_benchmark(values=10_000_000, batch=100_000):
+    data = [random.random() for _ in range(values)]
+    if np is not None: data = np.array(data)
+    batches = [data[i:i+batch] for i in range(0, values, batch)]
+
+    start = time.perf_counter()
+    _one_at_a_time(data[:values // 10])
+    elapsed = time.perf_counter() - start
+    print(f'one at a time: {values / 10 / elapsed:12.0f} values/s')
+
+    start = time.perf_counter()
+    stats = RunningStats()
+    for b in batches: stats.add(b)
+    elapsed = time.perf_counter() - start
+    print(f'   in batches: {values / elapsed:12.0f} values/s')
+
+    start = time.perf_counter()
+    merged = RunningStats()
+    for part in run_tasks(_batch_stats, batches, 'process'):
+        merged.merge(part)
+    elapsed = time.perf_counter() - start
+    print(f'  in parallel: {values / elapsed:12.0f} values/s')
+    print(stats, merged, sep='\n')
+
+#stats_benchmark()
+
+
 
 ################################
 ##
@@ -344,14 +1043,209 @@ async def run():
     async for i in ticker(1, 10):
         print(i)
 
+#%% Running coroutines requires an event loop. Getting the current one with
+#   asyncio.get_event_loop() is deprecated outside of coroutines [v3.10], and
+# once closed, a loop cannot be used again. asyncio.run() instead creates a
+# new loop and closes it for each call, which has a cost when called again
+# and again, e.g. from a driver program running many jobs. A runner keeps a
+# single loop for all of them, created by a pluggable factory, e.g. uvloop,
+# a faster drop-in implementation of the loop (https://github.com/MagicStack
+# /uvloop), when installed. (asyncio.Runner [v3.11] works along these lines.)
+import atexit
+
+def new_event_loop():
+    '''Return a new event loop, a faster one if uvloop is installed'''
+    try:
+        import uvloop
+        return uvloop.new_event_loop()
+    except ModuleNotFoundError:
+        return asyncio.new_event_loop()
+
+class LoopRunner:
+    '''Runs coroutines one after the other, all on the same event loop'''
+
+    def __init__(self, loop_factory=new_event_loop):
+        self.loop_factory = loop_factory
+        self.loop = None
+
+    def run(self, coro):
+        if self.loop is None or self.loop.is_closed():
+            self.loop = self.loop_factory()
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        loop = self.loop
+        if loop is None or loop.is_closed(): return
+        try:                            # same clean-up as asyncio.run()
+            tasks = asyncio.all_tasks(loop)
+            for t in tasks: t.cancel()
+            if tasks:
+                loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+runner = LoopRunner()                   # shared by the demos of this file
+atexit.register(runner.close)
+
 def async_ticker_demo():
-    loop = asyncio.get_event_loop()
+    runner.run(run())
+
+#async_ticker_demo()
+
+
+#%% Benchmark: cost of starting and closing a loop for each job vs. reusing
+#   the runner's loop, with each available loop implementation.
+async def _nothing():
+    pass
+
+def loop_benchmark(repeat=1000):
+    factories = {'asyncio': asyncio.new_event_loop}
+    try:
+        import uvloop
+        factories['uvloop'] = uvloop.new_event_loop
+    except ModuleNotFoundError:
+        pass
+    for name, factory in factories.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            with LoopRunner(factory) as once: once.run(_nothing())
+        each = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        with LoopRunner(factory) as reused:
+            for _ in range(repeat): reused.run(_nothing())
+        reuse = (time.perf_counter() - start) / repeat
+        print(f'{name:>8}: new loop per job {each*1e6:7.1f} us,'
+              f' reused loop {reuse*1e6:5.1f} us per job')
+
+#loop_benchmark()
+
+
+#%% Asynchronous generators compose, like generators do (see section 08).
+#   These combinators consume many asynchronous sources at once, with a
+# single event loop: merge them, map an async function over them with a
+# bounded number of calls in progress, group their items in batches (by size
+# or time), or limit their rate.
+
+async def amerge(*sources):
+    '''Yield the items of all sources, in the order they become available'''
+    queue = asyncio.Queue()
+    async def pump(source):
+        try:
+            async for item in source: await queue.put((True, item))
+        except Exception as exc:
+            await queue.put((False, exc))
+        await queue.put((False, None))              # this source is done
+    tasks = [asyncio.create_task(pump(source)) for source in sources]
     try:
-        loop.run_until_complete(run())
+        running = len(tasks)
+        while running:
+            ok, item = await queue.get()
+            if ok: yield item
+            elif item is None: running -= 1
+            else: raise item
     finally:
-        loop.close()
+        for t in tasks: t.cancel()
 
-#async_ticker_demo()
+async def amap(fun, source, limit=10):
+    '''Yield the results of await fun(item), at most limit at once'''
+    pending = set()
+    try:
+        async for item in source:
+            if len(pending) >= limit:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done: yield t.result()
+            pending.add(asyncio.create_task(fun(item)))
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done: yield t.result()
+    finally:
+        for t in pending: t.cancel()
+
+async def abatch(source, size=100, timeout=0.1):
+    '''Yield lists of size items, or fewer once timeout seconds elapsed'''
+    loop = asyncio.get_running_loop()
+    source = aiter(source)                          # built-in [v3.10]
+    batch, deadline, step = [], None, None
+    try:
+        while True:
+            if step is None: step = asyncio.ensure_future(anext(source))
+            wait = max(0, deadline - loop.time()) if batch else None
+            done, _ = await asyncio.wait({step}, timeout=wait)
+            if not done:                            # timeout
+                yield batch
+                batch = []
+                continue
+            try:
+                item = step.result()
+            except StopAsyncIteration:
+                break
+            step = None
+            if not batch: deadline = loop.time() + timeout
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch: yield batch
+    finally:
+        if step is not None: step.cancel()
+
+async def athrottle(source, rate, burst=1):
+    '''Yield the items of source, at most rate per second (token bucket)'''
+    loop = asyncio.get_running_loop()
+    tokens, last = burst, loop.time()
+    async for item in source:
+        now = loop.time()
+        tokens = min(burst, tokens + (now - last) * rate)
+        last = now
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) / rate)
+            tokens, last = 1, loop.time()
+        tokens -= 1
+        yield item
+
+async def combinators_demo():
+    async def double(i):
+        await asyncio.sleep(0.2)
+        return 2 * i
+    tickers = amerge(ticker(0.1, 10), ticker(0.25, 10), ticker(0.5, 5))
+    async for batch in abatch(amap(double, tickers, limit=4), 5, 0.3):
+        print(batch)
+    async for i in athrottle(ticker(0, 10), rate=4):
+        print(i, end=' ')
+
+#asyncio.run(combinators_demo())
+
+
+#%% Benchmark: event loop overhead per item, for one ticker vs. many tickers
+#   consumed concurrently, merged into one stream.
+async def _consume_all(source):
+    count = 0
+    async for _ in source: count += 1
+    return count
+
+def combinators_benchmark(sources=10_000, items=10):
+    for name, source in (
+            ('1 ticker', lambda: ticker(0, sources * items)),
+            (f'{sources} merged tickers',
+             lambda: amerge(*(ticker(0, items) for _ in range(sources))))):
+        start = time.perf_counter()
+        count = runner.run(_consume_all(source()))
+        elapsed = time.perf_counter() - start
+        print(f'{name:>22}: {count} items,'
+              f' {elapsed / count * 1e6:6.2f} us per item')
+
+#combinators_benchmark()
 
 
 
@@ -427,11 +1321,160 @@ async def say_all():
 # asyncio.run(say_all())
 
 
+#%% Structured concurrency [v3.11]: a task group starts any number of tasks
+#   and, when leaving the 'async with' block, waits until all are done. If
+# one of them fails, all the others are cancelled, and the exception(s) are
+# raised together as an ExceptionGroup. The runner below also limits the
+# number of tasks running at once (e.g. connections to a server), sets a
+# timeout for each task, and measures the gain due to concurrency, i.e. the
+# sum of the tasks' times vs. the total (wall) time.
+
+async def run_all(coros, limit=100, timeout=None):
+    '''Run the coroutines, at most limit at once, and return their results'''
+    semaphore = asyncio.Semaphore(limit)
+    durations = []
+
+    async def timed(coro):
+        try:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    return await asyncio.wait_for(coro, timeout)
+                finally:
+                    durations.append(time.perf_counter() - start)
+        finally:
+            coro.close()                # in case it was cancelled unstarted
+
+    start = time.perf_counter()
+    async with asyncio.TaskGroup() as group:
+        tasks = [group.create_task(timed(coro)) for coro in coros]
+    wall = time.perf_counter() - start
+    busy = sum(durations)
+    longest = max(durations, default=0)
+    print(f'{len(tasks)} tasks: wall time {wall:.3f} s,'
+          f' sum of task times {busy:.3f} s (longest {longest:.3f} s),'
+          f' concurrency gain {busy / wall:.1f}x')
+    return [t.result() for t in tasks]
+
+async def say_many(number=1000, limit=100):
+    async def say_after(delay, what):   # same as above, but quiet
+        await asyncio.sleep(delay)
+        return what
+    words = await run_all([say_after(random.uniform(0.5, 1), f'hello {n}')
+                           for n in range(number)], limit)
+    print(words[:3], '...')
+
+#asyncio.run(say_many())
+
+async def fail_fast():
+    async def fail(delay):
+        await asyncio.sleep(delay)
+        raise ValueError(f'failed after {delay}s')
+    try:
+        await run_all([say_after(2, 'never said'), fail(1)], timeout=5)
+    except ExceptionGroup as errors:    # the other task was cancelled
+        print('errors:', errors.exceptions)
+
+#asyncio.run(fail_fast())
+
+
 #%% Another excellent, in-depth tutorial about asyncio is from Real Python
 #  again at: https://realpython.com/async-io-python/
 
 
 
+################################
+##
+##  ASYNCHRONOUS PIPELINES
+##
+
+
+#%% The producer/consumer example from the coroutines section, revisited with
+#   asyncio: producers and consumers are now tasks, any number of each, that
+# communicate via a queue. As the queue is bounded, a producer that gets too
+# far ahead waits on put() until the consumers catch up (backpressure), so
+# that memory use stays bounded too. Consumers take all the batches that are
+# ready at once, keep running statistics (see the coroutines section), which
+# are merged and reported only at the end.
+
+async def produce_async(queue, batches, batch_size=3):
+    '''Puts batches of random integers in the queue, with their timestamp'''
+    for _ in range(batches):
+        data = [random.randrange(10) for _ in range(batch_size)]
+        await queue.put((time.perf_counter(), data))    # wait if full
+
+async def consume_async(queue, latencies, max_batches=64):
+    '''Keeps running statistics of the integers received, until None'''
+    stats = RunningStats()
+    while True:
+        ready = [await queue.get()]
+        while (len(ready) < max_batches and not queue.empty()
+               and ready[-1] is not None):      # leave other consumers'
+            ready.append(queue.get_nowait())    # stop signal in the queue
+        now = time.perf_counter()
+        done = ready[-1] is None
+        if done: ready.pop()
+        latencies.extend(now - created for created, _ in ready)
+        stats.add([x for _, data in ready for x in data])
+        if done: return stats
+
+async def pipeline(producers=4, consumers=4, batches=1000, batch_size=3,
+                   maxsize=100):
+    queue = asyncio.Queue(maxsize)
+    latencies = []
+    workers = [asyncio.create_task(consume_async(queue, latencies))
+               for _ in range(consumers)]
+    share, extra = divmod(batches, producers)      # all the batches
+    await asyncio.gather(*(produce_async(queue, share + (n < extra),
+                                         batch_size)
+                           for n in range(producers)))
+    for _ in workers: await queue.put(None)         # one stop per consumer
+    stats = RunningStats()
+    for partial in await asyncio.gather(*workers): stats.merge(partial)
+    print(f'The running average is {stats.mean}')
+    return latencies
+
+#asyncio.run(pipeline())
+
+
+#%% Benchmark: items per second and latency (from production to consumption)
+#   of the generator version (printing each step, to a dummy output) vs. the
+# asyncio version, with small and larger batches.
+import io
+import contextlib
+
+def _report(name, items, elapsed, latencies):
+    q = statistics.quantiles(latencies, n=100)
+    print(f'{name:>23}: {items / elapsed:10.0f} items/s,'
+          f' latency p50 {q[49]*1e6:8.1f} us, p99 {q[98]*1e6:8.1f} us')
+
+def pipeline_benchmark(items=300_000):
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        consumer = consume()
+        consumer.send(None)
+        producer = produce(consumer)
+        start = time.perf_counter()
+        for _ in range(items // 3):
+            step = time.perf_counter()
+            next(producer)
+            latencies.append(time.perf_counter() - step)
+        elapsed = time.perf_counter() - start
+    _report('generators', items // 3 * 3, elapsed, latencies)
+
+    for batch_size in (3, 100):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies = runner.run(pipeline(batches=items // batch_size,
+                                            batch_size=batch_size))
+        elapsed = time.perf_counter() - start
+        _report(f'asyncio, batches of {batch_size}',
+                len(latencies) * batch_size, elapsed, latencies)
+
+#pipeline_benchmark()
+
+
+
 ##
 ##  END
 ##